@@ -4,12 +4,16 @@
 # 
 import os
 import logging
+import threading
 
 class BoxFSBase:
     """Base class for BoxFS implementations
 
     """
 
+    # True while the tree is still being populated
+    loading = False
+
     def __init__(self):
         pass
 
@@ -173,6 +177,60 @@ class BoxFS(BoxFSBase):
                 return True
         return False
 
+def parse_conf_line(line):
+    """Parse a single line from a BoxFS conf file
+
+    Returns a tuple ('USER',uid,name) or ('FILE',path,target,access),
+    or None for comments and blank lines. Raises ValueError if the
+    line isn't valid.
+    """
+    # Conf file is tab-delimited
+    # Lines starting with # are comments, blank lines are ignored
+    # Lines starting with USER define user name and UID
+    # Lines starting with FILE define files, targets and (optionally) permissions
+    if line.startswith('#') or line.strip() == '':
+        return None
+    elif line.startswith('USER'):
+        # e.g. USER    pjb     1000
+        fields = line.strip('\n').split('\t')
+        try:
+            if len(fields) == 3:
+                return ('USER',int(fields[2]),fields[1])
+        except ValueError:
+            pass
+        raise ValueError("Bad line: %s" % line.strip())
+    elif line.startswith('FILE'):
+        # e.g. FILE    virtfile    /actual/file     1000
+        fields = line.strip('\n').split('\t')
+        try:
+            if len(fields) == 4:
+                if fields[3]:
+                    access = [int(x) for x in fields[3].split(',')]
+                else:
+                    access = []
+                return ('FILE',fields[1],fields[2],access)
+        except ValueError:
+            pass
+        raise ValueError("Bad line: %s" % line.strip('\n'))
+    else:
+        raise ValueError("Unrecognised line: %s" % line.strip())
+
+def read_conf(conf_file):
+    """Iterate over the entries in a BoxFS conf file
+
+    Yields tuples ('USER',uid,name) and ('FILE',path,target,access)
+    in the order they appear in the file. Bad lines are reported
+    and skipped.
+    """
+    for line in open(conf_file,'r'):
+        try:
+            entry = parse_conf_line(line)
+        except ValueError as ex:
+            logging.error(ex)
+            continue
+        if entry is not None:
+            yield entry
+
 class BoxConfFile:
     """Handle configuration file for BoxFS
     """
@@ -185,38 +243,16 @@ class BoxConfFile:
         self.load_conf()
 
     def load_conf(self):
-        # Conf file is tab-delimited
-        # Lines starting with # are comments, blank lines are ignored
-        # Lines starting with USER define user name and UID
-        # Lines starting with FILE define files, targets and (optionally) permissions
         if self.__conf_file is None:
             return
-        for line in open(self.__conf_file,'r'):
-            if line.startswith('#') or line.strip() == '':
-                continue
-            elif line.startswith('USER'):
-                # e.g. USER    pjb     1000
-                fields = line.strip('\n').split('\t')
-                if len(fields) == 3:
-                    self.users[int(fields[2])] = fields[1]
-                else:
-                    logging.error("Bad line: %s" % line.strip())
-                    continue
-            elif line.startswith('FILE'):
-                # e.g. FILE    virtfile    /actual/file     1000
-                fields = line.strip('\n').split('\t')
-                if len(fields) == 4:
-                    self.files[fields[1]] = fields[2]
-                    if fields[3]:
-                        self.access[fields[1]] = [int(x) for x in fields[3].split(',')]
-                    else:
-                        self.access[fields[1]] = []
-                else:
-                    logging.error("Bad line: %s" % line.strip('\n'))
-                    continue
-            else:
-                logging.error("Unrecognised line: %s" % line.strip())
-                continue
+        for entry in read_conf(self.__conf_file):
+            if entry[0] == 'USER':
+                uid,name = entry[1:]
+                self.users[uid] = name
+            elif entry[0] == 'FILE':
+                path,target,access = entry[1:]
+                self.files[path] = target
+                self.access[path] = access
 
     def save(self,conf_file):
         """Save data to a new file
@@ -273,6 +309,9 @@ class PassThroughBoxFS:
 
     """
 
+    # Tree is the real file system so is always complete
+    loading = False
+
     def __init__(self,root):
         self.__root = root
 
@@ -324,6 +363,225 @@ class PassThroughBoxFS:
         """
         return True
 
+class LazyBoxFS(BoxFS):
+    """BoxFS implementation populated from a conf file in the background
+
+    The tree can be used as soon as 'load' has been called. Loading
+    reads the conf file twice at the same time: one reader adds the
+    entries to the tree in batches, while a quicker one only scans
+    for paths to build an index of which files exist and which line
+    is the last one under each directory.
+
+    Files which have already been added are available immediately.
+    Other lookups block until the path turns up, or until the index
+    shows that it doesn't exist. Directory listings and access checks
+    block only until all the lines under that directory have been
+    added (access is granted straight away if an accessible file
+    below the directory has already been added).
+    """
+
+    def __init__(self,conf_file,batch_size=1000):
+        """Create new LazyBoxFS instance
+        """
+        BoxFS.__init__(self)
+        self.__conf_file = conf_file
+        self.__batch_size = batch_size
+        self.__lock = threading.Condition()
+        self.__paths = None
+        self.__last_line = None
+        self.__nlines = 0
+
+    def load(self):
+        """Start populating the tree in the background
+
+        The conf file is opened before returning, so IOError is
+        raised straight away if it can't be read.
+        """
+        fp = open(self.__conf_file,'r')
+        index_fp = open(self.__conf_file,'r')
+        self.loading = True
+        indexer = threading.Thread(target=self.__index,args=(index_fp,),
+                                   name="boxfs-indexer")
+        indexer.daemon = True
+        indexer.start()
+        loader = threading.Thread(target=self.__load,args=(fp,),
+                                  name="boxfs-loader")
+        loader.daemon = True
+        loader.start()
+        return loader
+
+    def __load(self,fp):
+        # Add entries from the conf file to the tree in batches,
+        # waking up any waiting lookups after each one
+        logging.debug("LOAD %s" % self.__conf_file)
+        try:
+            batch = []
+            nlines = 0
+            for line in fp:
+                nlines += 1
+                try:
+                    entry = parse_conf_line(line)
+                except ValueError as ex:
+                    logging.error(ex)
+                    entry = None
+                if entry is not None:
+                    batch.append(entry)
+                if nlines % self.__batch_size == 0:
+                    self.__add_batch(batch,nlines)
+                    batch = []
+            self.__add_batch(batch,nlines)
+        except Exception as ex:
+            logging.error("Failed to load %s: %s" % (self.__conf_file,ex))
+        finally:
+            fp.close()
+            with self.__lock:
+                self.loading = False
+                self.__paths = None
+                self.__last_line = None
+                self.__lock.notify_all()
+        logging.debug("LOAD finished %s" % self.__conf_file)
+
+    def __index(self,fp):
+        # Scan the conf file for file paths, noting the number of
+        # the last line below each directory (once that line has
+        # been added the directory is complete)
+        paths = set()
+        last_line = {'/': -1}
+        try:
+            for i,line in enumerate(fp):
+                if not line.startswith('FILE'):
+                    continue
+                fields = line.split('\t')
+                if len(fields) != 4:
+                    continue
+                path = self.normalise_path(fields[1])
+                paths.add(path)
+                dirpath = os.path.dirname(path)
+                while dirpath not in ('','/'):
+                    last_line[dirpath] = i
+                    dirpath = os.path.dirname(dirpath)
+                last_line['/'] = i
+        except Exception as ex:
+            logging.error("Failed to index %s: %s" % (self.__conf_file,ex))
+            return
+        finally:
+            fp.close()
+        with self.__lock:
+            if self.loading:
+                self.__paths = paths
+                self.__last_line = last_line
+                self.__lock.notify_all()
+        logging.debug("LOAD indexed %d files in %d directories" %
+                      (len(paths),len(last_line)))
+
+    def __add_batch(self,batch,nlines):
+        # Add a set of conf file entries to the tree, along with
+        # the number of lines read so far
+        with self.__lock:
+            for entry in batch:
+                if entry[0] == 'USER':
+                    uid,name = entry[1:]
+                    self.users[uid] = name
+                elif entry[0] == 'FILE':
+                    path,target,access = entry[1:]
+                    # Publish the complete access list before the file
+                    # itself, so unlocked lookups never see a partial
+                    # list (later entries replace earlier ones)
+                    self.access[self.normalise_path(path)] = set(access)
+                    BoxFS.add_file(self,path,target)
+            self.__nlines = nlines
+            self.__lock.notify_all()
+
+    def __is_known(self,path):
+        # Return True if path has been added, or if the index shows
+        # that it will never be added (caller holds the lock)
+        if path in self.files or path in self.dirs:
+            return True
+        return self.__paths is not None and \
+            path not in self.__paths and path not in self.__last_line
+
+    def __is_complete(self,path):
+        # Return True if no more entries will be added under the
+        # directory path (caller holds the lock)
+        if self.__last_line is None:
+            return False
+        return self.__last_line.get(path,-1) < self.__nlines
+
+    def wait_for(self,path):
+        """Block until path is in the tree or is known not to exist
+        """
+        if not self.loading:
+            return
+        path = self.normalise_path(path)
+        with self.__lock:
+            while self.loading and not self.__is_known(path):
+                self.__lock.wait()
+
+    def wait_for_dir(self,path):
+        """Block until the contents of a directory are complete
+        """
+        if not self.loading:
+            return
+        path = self.normalise_path(path)
+        with self.__lock:
+            while self.loading and not self.__is_complete(path):
+                self.__lock.wait()
+
+    def wait_loaded(self):
+        """Block until loading has finished
+        """
+        if not self.loading:
+            return
+        with self.__lock:
+            while self.loading:
+                self.__lock.wait()
+
+    def target_for(self,path):
+        """Returns the target for a file
+        """
+        try:
+            return BoxFS.target_for(self,path)
+        except KeyError:
+            if not self.loading:
+                raise
+        self.wait_for(path)
+        return BoxFS.target_for(self,path)
+
+    def is_dir(self,path):
+        """Returns True if path is a directory
+        """
+        if not BoxFS.is_dir(self,path):
+            self.wait_for(path)
+        return BoxFS.is_dir(self,path)
+
+    def is_file(self,path):
+        """Returns True if path is a file
+        """
+        if not BoxFS.is_file(self,path):
+            self.wait_for(path)
+        return BoxFS.is_file(self,path)
+
+    def list_dir(self,path,user=None):
+        """Returns directory contents
+        """
+        self.wait_for_dir(path)
+        return BoxFS.list_dir(self,path,user=user)
+
+    def has_access(self,path,user):
+        """Returns True is user has permission to access
+        """
+        if BoxFS.is_file(self,path) or not self.loading:
+            return BoxFS.has_access(self,path,user)
+        # Directory access means access to something below it, so
+        # the answer can be yes before the directory is complete
+        # (hold the lock so the tree doesn't change underneath)
+        with self.__lock:
+            if BoxFS.has_access(self,path,user):
+                return True
+        self.wait_for_dir(path)
+        with self.__lock:
+            return BoxFS.has_access(self,path,user)
+
 import unittest
 class TestBoxFS(unittest.TestCase):
     def setUp(self):
@@ -453,3 +711,74 @@ class TestBoxFS(unittest.TestCase):
         self.assertEqual(box.list_dir('/data',user=1000),['common','myfile','public'])
         self.assertEqual(box.list_dir('/data',user=1001),['common','hisfile','public'])
         self.assertEqual(box.list_dir('/data',user=1002),['public'])
+
+import shutil
+import tempfile
+class TestLazyBoxFS(unittest.TestCase):
+    def setUp(self):
+        self.wd = tempfile.mkdtemp()
+        self.conf_file = os.path.join(self.wd,'fusebox.conf')
+        fp = open(self.conf_file,'w')
+        fp.write("USER\tanonymouse\t1000\n"
+                 "USER\tcatweazle\t1001\n"
+                 "FILE\tdata/sub/public\t/data/file3\t\n"
+                 "FILE\tdata/myfile\t/data/file\t1000\n"
+                 "FILE\tdata/hisfile\t/data/file2\t1001\n")
+        fp.close()
+    def tearDown(self):
+        shutil.rmtree(self.wd)
+    def test_lazy_boxfs_before_loading(self):
+        box = LazyBoxFS(self.conf_file)
+        self.assertFalse(box.loading)
+        self.assertTrue(box.is_dir('/'))
+        self.assertEqual(box.list_dir('/'),[])
+    def test_lazy_boxfs_load(self):
+        box = LazyBoxFS(self.conf_file,batch_size=1)
+        box.load()
+        self.assertEqual(box.target_for('/data/sub/public'),'/data/file3')
+        self.assertRaises(KeyError,box.target_for,'/data/missing')
+        box.wait_loaded()
+        self.assertFalse(box.loading)
+        self.assertTrue(box.is_dir('/data/sub'))
+        self.assertFalse(box.is_file('/data/missing'))
+        self.assertEqual(sorted(box.list_users()),[1000,1001])
+        self.assertEqual(box.list_dir('/data'),['hisfile','myfile','sub'])
+        self.assertEqual(box.list_dir('/data',user=1000),['myfile','sub'])
+        self.assertTrue(box.has_access('/data/hisfile',1001))
+        self.assertFalse(box.has_access('/data/hisfile',1000))
+    def test_lazy_boxfs_missing_conf_file(self):
+        box = LazyBoxFS(os.path.join(self.wd,'missing.conf'))
+        self.assertRaises(IOError,box.load)
+        self.assertFalse(box.loading)
+    def test_lazy_boxfs_skips_bad_lines(self):
+        fp = open(self.conf_file,'a')
+        fp.write("USER\tnobody\tnone\n"
+                 "FILE\tdata/bad\t/data/file5\tpjb\n"
+                 "FILE\tdata/good\t/data/file6\t1000\n")
+        fp.close()
+        box = LazyBoxFS(self.conf_file)
+        box.load().join()
+        self.assertFalse(box.is_file('/data/bad'))
+        self.assertEqual(box.target_for('/data/good'),'/data/file6')
+        self.assertEqual(box.list_dir('/data'),
+                         ['good','hisfile','myfile','sub'])
+    def test_lazy_boxfs_partially_loaded(self):
+        box = LazyBoxFS(self.conf_file)
+        box.loading = True
+        box._LazyBoxFS__index(open(self.conf_file))
+        box._LazyBoxFS__add_batch(list(read_conf(self.conf_file))[:4],4)
+        self.assertFalse(box.is_file('/data/missing'))
+        self.assertFalse(box.is_dir('/other'))
+        self.assertEqual(box.list_dir('/data/sub'),['public'])
+        self.assertTrue(box.has_access('/data',1000))
+        self.assertTrue(box.has_access('/data/myfile',1000))
+        self.assertFalse(box.has_access('/data/myfile',1001))
+    def test_lazy_boxfs_later_entry_replaces_access(self):
+        fp = open(self.conf_file,'a')
+        fp.write("FILE\tdata/myfile\t/data/file4\t1001\n")
+        fp.close()
+        box = LazyBoxFS(self.conf_file)
+        box.load().join()
+        self.assertEqual(box.target_for('/data/myfile'),'/data/file4')
+        self.assertTrue(box.has_access('/data/myfile',1001))
+        self.assertFalse(box.has_access('/data/myfile',1000))
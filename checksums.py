@@ -0,0 +1,328 @@
+# checksums
+#
+# Background computation and caching of checksums for target files
+#
+import os
+import time
+import errno
+import hashlib
+import logging
+import threading
+import Queue
+
+class ChecksumCache:
+    """Compute and cache checksums for files in the real file system
+
+    Checksums are computed by a pool of background worker
+    threads and stored against the path, size and modification
+    time of the file, so that a file which changes is hashed
+    again on the next request. Only the most recent checksums
+    for each file are kept.
+
+    If a file can't be read then the error is reported by
+    subsequent lookups until the file changes or 'failure_timeout'
+    seconds have passed, after which it will be tried again.
+
+    If a cache file is supplied then checksums are loaded from
+    it on start up (discarding any out of date entries), and new
+    checksums are appended to it as they are computed. Files
+    with tabs or newlines in their paths can't be stored in the
+    cache file and are only cached in memory.
+    """
+
+    def __init__(self,cache_file=None,algorithms=('md5','sha1'),
+                 nworkers=2,blocksize=1024*1024,failure_timeout=300):
+        """Create new ChecksumCache instance
+        """
+        for algorithm in algorithms:
+            hashlib.new(algorithm)
+        self.algorithms = tuple(algorithms)
+        self.failure_timeout = failure_timeout
+        self.__cache_file = cache_file
+        self.__blocksize = blocksize
+        self.__checksums = dict()
+        self.__failed = dict()
+        self.__pending = set()
+        self.__queue = Queue.Queue()
+        self.__lock = threading.Condition()
+        self.load_cache()
+        for i in range(nworkers):
+            worker = threading.Thread(target=self.__worker,
+                                      name="checksum-worker-%d" % i)
+            worker.daemon = True
+            worker.start()
+
+    def load_cache(self):
+        # Cache file is tab-delimited
+        # Lines starting with # are comments, blank lines are ignored
+        # Other lines give target, size, mtime and checksums
+        # e.g. /actual/file    1024    1387297854.0    md5:d41d8...,sha1:da39a...
+        # Later lines override earlier ones for the same target, and
+        # the file is rewritten afterwards to drop the overridden lines
+        if self.__cache_file is None or not os.path.exists(self.__cache_file):
+            return
+        for line in open(self.__cache_file,'r'):
+            if line.startswith('#') or line.strip() == '':
+                continue
+            fields = line.strip('\n').split('\t')
+            try:
+                target,size,mtime,sums = fields
+                key = (target,int(size),float(mtime))
+                checksums = dict([x.split(':',1) for x in sums.split(',')])
+            except ValueError:
+                logging.error("Bad line in checksum cache: %s" % line.strip('\n'))
+                continue
+            self.__checksums[target] = (key,checksums)
+        self.__compact()
+
+    def key_for(self,target):
+        """Return the cache key for a target file
+        """
+        st = os.stat(target)
+        return (target,st.st_size,st.st_mtime)
+
+    def request(self,target):
+        """Queue a target file for checksumming
+
+        Nothing is queued if the checksums are already known, if
+        the file is already queued, or if it failed recently.
+
+        Returns the cache key for the file.
+        """
+        key = self.key_for(target)
+        with self.__lock:
+            if self.__cached(key) or key in self.__pending:
+                return key
+            if target in self.__failed:
+                failed_key,err,when = self.__failed[target]
+                if failed_key == key and \
+                   time.time() - when < self.failure_timeout:
+                    return key
+                del self.__failed[target]
+            self.__pending.add(key)
+        self.__queue.put(key)
+        return key
+
+    def lookup(self,target,algorithm,wait=False,timeout=None):
+        """Return the checksum for a target file
+
+        If the checksum isn't available yet then the file is
+        queued for checksumming and either None is returned
+        immediately, or (if 'wait' is True) the call blocks until
+        the checksum is available or 'timeout' seconds have passed.
+
+        Raises ValueError if the algorithm isn't supported, or
+        IOError/OSError if the file couldn't be read.
+        """
+        if algorithm not in self.algorithms:
+            raise ValueError("Unsupported checksum algorithm '%s'" % algorithm)
+        key = self.request(target)
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self.__lock:
+            while True:
+                checksums = self.__cached(key)
+                if checksums:
+                    return checksums[algorithm]
+                if target in self.__failed and \
+                   self.__failed[target][0] == key:
+                    err = self.__failed[target][1]
+                    raise IOError(err,os.strerror(err),target)
+                if not wait:
+                    return None
+                if timeout is None:
+                    self.__lock.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    self.__lock.wait(remaining)
+
+    def compute(self,target):
+        """Compute checksums for a file
+
+        Returns a tuple (key,checksums), where the key comes from the
+        open file once it has been read (so it describes the version
+        of the file that was actually checksummed).
+        """
+        hashes = [hashlib.new(algorithm) for algorithm in self.algorithms]
+        fp = open(target,'rb')
+        try:
+            while True:
+                block = fp.read(self.__blocksize)
+                if not block:
+                    break
+                for h in hashes:
+                    h.update(block)
+            st = os.fstat(fp.fileno())
+        finally:
+            fp.close()
+        return ((target,st.st_size,st.st_mtime),
+                dict(zip(self.algorithms,[h.hexdigest() for h in hashes])))
+
+    def __cached(self,key):
+        # Return checksums stored for key, or None if there
+        # aren't any (or they're for an older version of the file)
+        try:
+            cached_key,checksums = self.__checksums[key[0]]
+        except KeyError:
+            return None
+        if cached_key != key:
+            return None
+        return checksums
+
+    def __worker(self):
+        # Worker thread: take keys off the queue and checksum them
+        while True:
+            key = self.__queue.get()
+            target = key[0]
+            logging.debug("CHECKSUM %s" % target)
+            try:
+                computed_key,checksums = self.compute(target)
+            except (IOError,OSError) as ex:
+                logging.error("Failed to checksum %s: %s" % (target,ex))
+                with self.__lock:
+                    self.__pending.discard(key)
+                    self.__failed[target] = (key,ex.errno or errno.EIO,
+                                             time.time())
+                    self.__lock.notify_all()
+                continue
+            if computed_key != key:
+                # File changed while it was being read, so the checksums
+                # may not match either version: try again
+                logging.debug("CHECKSUM %s changed, requeuing" % target)
+                with self.__lock:
+                    self.__pending.discard(key)
+                    self.__lock.notify_all()
+                try:
+                    self.request(target)
+                except OSError as ex:
+                    logging.error("Failed to checksum %s: %s" % (target,ex))
+                continue
+            with self.__lock:
+                self.__pending.discard(key)
+                self.__checksums[target] = (key,checksums)
+                if self.__cache_file is not None:
+                    self.__save(key,checksums)
+                self.__lock.notify_all()
+
+    def __format(self,key,checksums):
+        # Return line for the cache file, or None if the target
+        # path can't be represented in the file format
+        if '\t' in key[0] or '\n' in key[0]:
+            return None
+        return '%s\t%d\t%r\t%s\n' % (key[0],key[1],key[2],
+                                    ','.join(['%s:%s' % (a,checksums[a])
+                                              for a in self.algorithms]))
+
+    def __save(self,key,checksums):
+        # Append an entry to the cache file
+        line = self.__format(key,checksums)
+        if line is None:
+            logging.debug("Not adding %r to checksum cache" % key[0])
+            return
+        try:
+            fp = open(self.__cache_file,'a')
+            fp.write(line)
+            fp.close()
+        except IOError as ex:
+            logging.error("Failed to update checksum cache %s: %s" %
+                          (self.__cache_file,ex))
+
+    def __compact(self):
+        # Rewrite the cache file with only the current entries
+        tmp_file = "%s.tmp" % self.__cache_file
+        try:
+            fp = open(tmp_file,'w')
+            for target in sorted(self.__checksums):
+                line = self.__format(*self.__checksums[target])
+                if line is not None:
+                    fp.write(line)
+            fp.close()
+            os.rename(tmp_file,self.__cache_file)
+        except (IOError,OSError) as ex:
+            logging.error("Failed to rewrite checksum cache %s: %s" %
+                          (self.__cache_file,ex))
+
+import unittest
+import shutil
+import tempfile
+class TestChecksumCache(unittest.TestCase):
+    def setUp(self):
+        self.wd = tempfile.mkdtemp()
+        self.target = os.path.join(self.wd,'data.txt')
+        fp = open(self.target,'w')
+        fp.write('hello world\n')
+        fp.close()
+        self.cache_file = os.path.join(self.wd,'checksums.txt')
+    def tearDown(self):
+        shutil.rmtree(self.wd)
+    def test_lookup_and_wait(self):
+        cache = ChecksumCache()
+        self.assertEqual(cache.lookup(self.target,'md5',wait=True),
+                         '6f5902ac237024bdd0c176cb93063dc4')
+        self.assertEqual(cache.lookup(self.target,'sha1'),
+                         '22596363b3de40b06f981fb85d82312e8c0ed511')
+    def test_lookup_without_wait(self):
+        cache = ChecksumCache(nworkers=0)
+        self.assertEqual(cache.lookup(self.target,'md5'),None)
+        self.assertEqual(cache.lookup(self.target,'md5',wait=True,timeout=0.01),None)
+    def test_lookup_unsupported_algorithm(self):
+        cache = ChecksumCache()
+        self.assertRaises(ValueError,cache.lookup,self.target,'sha256')
+    def test_lookup_missing_file(self):
+        cache = ChecksumCache()
+        self.assertRaises(OSError,cache.lookup,
+                          os.path.join(self.wd,'missing'),'md5')
+    def test_changed_file_is_checksummed_again(self):
+        cache = ChecksumCache()
+        cache.lookup(self.target,'md5',wait=True)
+        fp = open(self.target,'a')
+        fp.write('goodbye\n')
+        fp.close()
+        self.assertNotEqual(cache.lookup(self.target,'md5',wait=True),
+                            '6f5902ac237024bdd0c176cb93063dc4')
+    def test_cache_file_persists_checksums(self):
+        cache = ChecksumCache(cache_file=self.cache_file)
+        cache.lookup(self.target,'md5',wait=True)
+        self.assertTrue(os.path.exists(self.cache_file))
+        cache = ChecksumCache(cache_file=self.cache_file,nworkers=0)
+        self.assertEqual(cache.lookup(self.target,'md5'),
+                         '6f5902ac237024bdd0c176cb93063dc4')
+    def test_cache_file_is_compacted(self):
+        fp = open(self.cache_file,'w')
+        fp.write("%s\t1\t1.0\tmd5:old,sha1:old\n" % self.target)
+        fp.write("%s\t2\t2.0\tmd5:older,sha1:older\n" % self.target)
+        fp.close()
+        cache = ChecksumCache(cache_file=self.cache_file,nworkers=0)
+        self.assertEqual(open(self.cache_file).read(),
+                         "%s\t2\t2.0\tmd5:older,sha1:older\n" % self.target)
+    def test_failure_is_reported_until_expiry(self):
+        class CountingChecksumCache(ChecksumCache):
+            ncomputed = 0
+            def compute(self,target):
+                self.ncomputed += 1
+                return ChecksumCache.compute(self,target)
+        cache = CountingChecksumCache()
+        self.assertRaises(IOError,cache.lookup,self.wd,'md5',wait=True)
+        for i in range(5):
+            self.assertRaises(IOError,cache.lookup,self.wd,'md5')
+        self.assertEqual(cache.ncomputed,1)
+        cache.failure_timeout = 0
+        self.assertRaises(IOError,cache.lookup,self.wd,'md5',wait=True)
+        self.assertEqual(cache.ncomputed,2)
+    def test_file_changed_while_reading_is_checksummed_again(self):
+        class ChangingChecksumCache(ChecksumCache):
+            ncomputed = 0
+            def compute(self,target):
+                self.ncomputed += 1
+                if self.ncomputed == 1:
+                    fp = open(target,'a')
+                    fp.write('goodbye\n')
+                    fp.close()
+                return ChecksumCache.compute(self,target)
+        cache = ChangingChecksumCache()
+        self.assertEqual(cache.lookup(self.target,'md5',wait=True,timeout=0.2),None)
+        self.assertEqual(cache.lookup(self.target,'md5',wait=True),
+                         hashlib.md5('hello world\ngoodbye\n').hexdigest())
+        self.assertEqual(cache.ncomputed,2)
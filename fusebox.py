@@ -19,17 +19,32 @@ from __future__ import with_statement
 
 import os
 import sys
+import stat
+import time
 import errno
 import logging
 import optparse
 
 from fuse import FUSE, FuseOSError, Operations, fuse_get_context
-from boxfs import PassThroughBoxFS, BoxFS, BoxConfFile
+from boxfs import PassThroughBoxFS, BoxFS, LazyBoxFS, BoxConfFile
+from checksums import ChecksumCache
+
+# Prefix for extended attributes exposing checksums
+XATTR_PREFIX = 'user.fusebox.'
+
+# Error for missing extended attributes (no ENOATTR on Linux)
+ENOATTR = getattr(errno,'ENOATTR',errno.ENODATA)
 
 class FuseBox(Operations):
 
-    def __init__(self,boxfs):
+    def __init__(self,boxfs,checksums=None,checksum_wait=False,
+                 checksum_timeout=10.0):
         self.boxfs = boxfs
+        self.checksums = checksums
+        self.checksum_wait = checksum_wait
+        self.checksum_timeout = checksum_timeout
+        self.mount_time = time.time()
+        self.dir_attrs = {}
 
     def context_uid(self):
         cxt = fuse_get_context()
@@ -39,6 +54,42 @@ class FuseBox(Operations):
         uid = self.context_uid()
         return self.boxfs.has_access(path,uid)
 
+    def dir_attr(self,path):
+        """Return synthetic attributes for a virtual directory
+
+        Virtual directories have no counterpart on the real
+        file system, so their attributes are made up from the
+        tree the first time they're needed and cached thereafter.
+
+        While the tree is still loading the number of subdirectories
+        isn't known yet, so the link count is reported as 1 (which
+        tools such as 'find' understand as "unknown") and nothing is
+        cached.
+        """
+        try:
+            return self.dir_attrs[path]
+        except KeyError:
+            pass
+        loading = self.boxfs.loading
+        if loading:
+            nlink = 1
+        else:
+            nlink = 2
+            for dirent in self.boxfs.list_dir(path):
+                if self.boxfs.is_dir(os.path.join(path,dirent)):
+                    nlink += 1
+        s = dict(st_mode=(stat.S_IFDIR | 0o555),
+                 st_nlink=nlink,
+                 st_uid=os.getuid(),
+                 st_gid=os.getgid(),
+                 st_size=0,
+                 st_atime=self.mount_time,
+                 st_ctime=self.mount_time,
+                 st_mtime=self.mount_time)
+        if not loading:
+            self.dir_attrs[path] = s
+        return s
+
     # Filesystem methods
     # ==================
 
@@ -61,7 +112,10 @@ class FuseBox(Operations):
         try:
             full_path = self.boxfs.target_for(path)
         except KeyError:
-            full_path = os.getcwd()
+            # Either a virtual directory or nothing at all
+            if self.boxfs.is_dir(path):
+                return self.dir_attr(path)
+            raise FuseOSError(errno.ENOENT)
         st = os.lstat(full_path)
         s = dict()
         for key in  ('st_atime', 'st_ctime',
@@ -74,6 +128,46 @@ class FuseBox(Operations):
                 logging.debug("statfs: no attr '%s'" % key)
         return s
 
+    def getxattr(self, path, name, position=0):
+        logging.debug("GETXATTR %s %s" % (path,name))
+        if self.checksums is None:
+            raise FuseOSError(errno.ENOTSUP)
+        algorithm = name[len(XATTR_PREFIX):]
+        if not (name.startswith(XATTR_PREFIX) and
+                algorithm in self.checksums.algorithms):
+            raise FuseOSError(ENOATTR)
+        try:
+            full_path = self.boxfs.target_for(path)
+        except KeyError:
+            raise FuseOSError(ENOATTR)
+        if not os.path.isfile(full_path):
+            raise FuseOSError(ENOATTR)
+        if not self.has_permission(path):
+            raise FuseOSError(errno.EACCES)
+        try:
+            checksum = self.checksums.lookup(full_path,algorithm,
+                                             wait=self.checksum_wait,
+                                             timeout=self.checksum_timeout)
+        except (IOError,OSError) as ex:
+            raise FuseOSError(ex.errno or errno.EIO)
+        if checksum is None:
+            # Not computed yet, client should try again later
+            raise FuseOSError(errno.EAGAIN)
+        return checksum
+
+    def listxattr(self, path):
+        logging.debug("LISTXATTR %s" % path)
+        if self.checksums is None:
+            return []
+        try:
+            full_path = self.boxfs.target_for(path)
+        except KeyError:
+            return []
+        if not os.path.isfile(full_path):
+            return []
+        return [XATTR_PREFIX+algorithm
+                for algorithm in self.checksums.algorithms]
+
     def readdir(self, path, fh):
         logging.debug("READDIR %s %s" % (path,fh))
         dirents = ['.', '..']
@@ -159,11 +253,17 @@ class FuseBox(Operations):
     def fsync(self, path, fdatasync, fh):
         return self.flush(path, fh)
 
-def main(fusebox,mountpoint,conf_file=None):
+def main(fusebox,mountpoint,conf_file=None,negative_timeout=None):
     # Need to set user_allow_other in /etc/fuse.conf for
     # allow_other option to work (or run this process as root)
     ##fusebox = FuseBox(conf_file)
-    FUSE(fusebox,mountpoint,foreground=True,allow_other=True)
+    # Setting negative_timeout lets the kernel cache ENOENT
+    # results so repeated lookups of missing names never reach
+    # fusebox
+    options = dict()
+    if negative_timeout is not None:
+        options['negative_timeout'] = negative_timeout
+    FUSE(fusebox,mountpoint,foreground=True,allow_other=True,**options)
 
 if __name__ == '__main__':
     
@@ -176,9 +276,38 @@ if __name__ == '__main__':
     p.add_option("--conf",action='store',dest='conf_file',default=None,
                  help="read user and file mapping info from CONF_FILE for 'mapped' "
                  "VFS")
+    p.add_option("--lazy",action='store_true',dest='lazy',
+                 help="mount 'mapped' VFS immediately and load CONF_FILE in "
+                 "the background")
     p.add_option("--root",action='store',dest='root_dir',default=None,
                  help="directory that root of 'passthrough' VFS maps onto in the "
                  "real filesystem")
+    p.add_option("--negative-timeout",action='store',dest='negative_timeout',
+                 type='float',default=None,
+                 help="number of seconds for the kernel to cache lookups of "
+                 "nonexistent names (default 60 for 'mapped' VFS, 0 for "
+                 "'passthrough')")
+    p.add_option("--checksums",action='store_true',dest='checksums',
+                 help="expose MD5 and SHA1 checksums of files as extended "
+                 "attributes ('user.fusebox.md5' and 'user.fusebox.sha1')")
+    p.add_option("--checksum-cache",action='store',dest='checksum_cache',
+                 default=None,
+                 help="store computed checksums in CHECKSUM_CACHE so that they "
+                 "persist between fusebox instances")
+    p.add_option("--checksum-workers",action='store',dest='checksum_workers',
+                 type='int',default=2,
+                 help="number of background threads used to compute "
+                 "checksums (default 2)")
+    p.add_option("--checksum-policy",action='store',dest='checksum_policy',
+                 type='choice',choices=('retry','wait'),
+                 default='retry',
+                 help="what to do when a checksum isn't available yet: "
+                 "'retry' (default) fails with EAGAIN, 'wait' blocks until "
+                 "it has been computed (up to CHECKSUM_TIMEOUT seconds)")
+    p.add_option("--checksum-timeout",action='store',dest='checksum_timeout',
+                 type='float',default=10.0,
+                 help="maximum number of seconds to wait for a checksum with "
+                 "'wait' policy before failing with EAGAIN (default 10)")
     p.add_option("--debug",action='store_true',dest='debug',
                  help="turn on debugging output")
     options,args = p.parse_args()
@@ -192,11 +321,33 @@ if __name__ == '__main__':
             p.error("'passthrough' VFS requires a root directory")
     elif options.vfs == 'mapped':
         # Read-only mapped VFS
-        if options.conf_file:
-            boxfs = BoxConfFile(conf_file).populate(BoxFS())
+        if options.conf_file and options.lazy:
+            boxfs = LazyBoxFS(options.conf_file)
+            try:
+                boxfs.load()
+            except IOError as ex:
+                p.error("Unable to read conf file: %s" % ex)
+        elif options.conf_file:
+            boxfs = BoxConfFile(options.conf_file).populate(BoxFS())
         else:
             p.error("'mapped' VFS requires a conf file")
     else:
         p.error("Unknown VFS type: '%s'" % options.vfs)
-    fusebox = FuseBox(boxfs)
-    main(fusebox,args[0])
+    negative_timeout = options.negative_timeout
+    if negative_timeout is None and options.vfs == 'mapped':
+        # Mapped tree is fixed until restart so misses can be
+        # cached; passthrough tree is live so leave it uncached
+        negative_timeout = 60.0
+    if options.checksum_workers < 1:
+        p.error("Need at least one checksum worker")
+    if options.checksum_timeout <= 0:
+        p.error("Checksum timeout must be greater than zero")
+    if options.checksums or options.checksum_cache:
+        checksums = ChecksumCache(cache_file=options.checksum_cache,
+                                  nworkers=options.checksum_workers)
+    else:
+        checksums = None
+    fusebox = FuseBox(boxfs,checksums=checksums,
+                      checksum_wait=(options.checksum_policy == 'wait'),
+                      checksum_timeout=options.checksum_timeout)
+    main(fusebox,args[0],negative_timeout=negative_timeout)
@@ -5,7 +5,7 @@ from setuptools import setup
 setup(
     name = 'fusebox',
     version = '0.0.1',
-    py_modules = ['fusebox','boxfs'],
+    py_modules = ['fusebox','boxfs','checksums'],
     install_requires = ['fusepy >= 2.0.2'],
     scripts = ['fusebox.py','manage_conf.py'],
     url = 'https://github.com/pjbriggs/fusebox',
@@ -0,0 +1,144 @@
+# test_fusebox
+#
+# Tests for the FuseBox operations
+#
+# These don't need a mount: if fusepy isn't available then a minimal
+# stand-in 'fuse' module is used so that fusebox can be imported
+import os
+import sys
+import stat
+import errno
+import types
+import shutil
+import tempfile
+import unittest
+
+try:
+    import fuse
+except (ImportError,EnvironmentError):
+    fuse = types.ModuleType('fuse')
+    class FuseOSError(OSError):
+        def __init__(self,errno):
+            OSError.__init__(self,errno,os.strerror(errno))
+    class Operations(object):
+        pass
+    def fuse_get_context():
+        raise RuntimeError("No FUSE context outside of a mount")
+    def FUSE(*args,**kws):
+        raise RuntimeError("Can't mount without fusepy")
+    fuse.FuseOSError = FuseOSError
+    fuse.Operations = Operations
+    fuse.fuse_get_context = fuse_get_context
+    fuse.FUSE = FUSE
+    sys.modules['fuse'] = fuse
+
+import fusebox
+from fusebox import FuseBox
+from boxfs import BoxFS
+from checksums import ChecksumCache
+
+class FuseBoxTestCase(unittest.TestCase):
+    def setUp(self):
+        self.wd = tempfile.mkdtemp()
+        self.target = os.path.join(self.wd,'data.txt')
+        fp = open(self.target,'w')
+        fp.write('hello world\n')
+        fp.close()
+        self.boxfs = BoxFS()
+        self.boxfs.add_file('data/myfile',self.target,access=[1000])
+        self.boxfs.add_file('data/sub/public',self.target)
+        self.boxfs.add_file('data/sub2/public',self.target)
+        # Requests come from uid 1000 unless a test changes it
+        self.uid = 1000
+        self.fuse_get_context = fusebox.fuse_get_context
+        fusebox.fuse_get_context = lambda: (self.uid,0,0)
+    def tearDown(self):
+        fusebox.fuse_get_context = self.fuse_get_context
+        shutil.rmtree(self.wd)
+    def assertFuseError(self,err,func,*args,**kws):
+        try:
+            func(*args,**kws)
+        except fuse.FuseOSError as ex:
+            self.assertEqual(ex.errno,err)
+        else:
+            self.fail("%s didn't raise FuseOSError" % func.__name__)
+
+class TestFuseBoxGetattr(FuseBoxTestCase):
+    def test_getattr_file(self):
+        box = FuseBox(self.boxfs)
+        s = box.getattr('/data/myfile')
+        self.assertTrue(stat.S_ISREG(s['st_mode']))
+        self.assertEqual(s['st_size'],12)
+    def test_getattr_missing_path(self):
+        box = FuseBox(self.boxfs)
+        self.assertFuseError(errno.ENOENT,box.getattr,'/missing')
+        self.assertFuseError(errno.ENOENT,box.getattr,'/data/missing')
+        self.assertFuseError(errno.ENOENT,box.getattr,'/data/myfile/missing')
+    def test_getattr_virtual_dir(self):
+        box = FuseBox(self.boxfs)
+        s = box.getattr('/data')
+        self.assertTrue(stat.S_ISDIR(s['st_mode']))
+        self.assertEqual(stat.S_IMODE(s['st_mode']),0o555)
+        self.assertEqual(s['st_uid'],os.getuid())
+        self.assertEqual(s['st_gid'],os.getgid())
+        self.assertEqual(s['st_mtime'],box.mount_time)
+        self.assertEqual(s['st_nlink'],4)
+        self.assertEqual(box.getattr('/')['st_nlink'],3)
+        self.assertEqual(box.getattr('/data/sub')['st_nlink'],2)
+    def test_getattr_virtual_dir_is_cached(self):
+        box = FuseBox(self.boxfs)
+        s = box.getattr('/data')
+        self.boxfs.add_file('data/sub3/public',self.target)
+        self.assertTrue(box.getattr('/data') is s)
+        self.assertEqual(box.getattr('/data')['st_nlink'],4)
+    def test_getattr_virtual_dir_while_loading(self):
+        box = FuseBox(self.boxfs)
+        self.boxfs.loading = True
+        s = box.getattr('/data')
+        self.assertEqual(s['st_nlink'],1)
+        self.boxfs.loading = False
+        self.assertEqual(box.getattr('/data')['st_nlink'],4)
+
+class TestFuseBoxXattr(FuseBoxTestCase):
+    def test_xattr_without_checksums(self):
+        box = FuseBox(self.boxfs)
+        self.assertFuseError(errno.ENOTSUP,box.getxattr,
+                             '/data/myfile','user.fusebox.md5')
+        self.assertEqual(box.listxattr('/data/myfile'),[])
+    def test_listxattr(self):
+        box = FuseBox(self.boxfs,checksums=ChecksumCache(nworkers=0))
+        self.assertEqual(box.listxattr('/data/myfile'),
+                         ['user.fusebox.md5','user.fusebox.sha1'])
+        self.assertEqual(box.listxattr('/data'),[])
+        self.assertEqual(box.listxattr('/missing'),[])
+    def test_getxattr_no_such_attribute(self):
+        box = FuseBox(self.boxfs,checksums=ChecksumCache(nworkers=0))
+        self.assertFuseError(fusebox.ENOATTR,box.getxattr,
+                             '/data/myfile','user.other')
+        self.assertFuseError(fusebox.ENOATTR,box.getxattr,
+                             '/data/myfile','user.fusebox.sha256')
+        self.assertFuseError(fusebox.ENOATTR,box.getxattr,
+                             '/data','user.fusebox.md5')
+        self.assertFuseError(fusebox.ENOATTR,box.getxattr,
+                             '/missing','user.fusebox.md5')
+    def test_getxattr_no_permission(self):
+        box = FuseBox(self.boxfs,checksums=ChecksumCache(nworkers=0))
+        self.uid = 1001
+        self.assertFuseError(errno.EACCES,box.getxattr,
+                             '/data/myfile','user.fusebox.md5')
+    def test_getxattr_retry_policy(self):
+        box = FuseBox(self.boxfs,checksums=ChecksumCache(nworkers=0))
+        self.assertFuseError(errno.EAGAIN,box.getxattr,
+                             '/data/myfile','user.fusebox.md5')
+    def test_getxattr_wait_policy_times_out(self):
+        box = FuseBox(self.boxfs,checksums=ChecksumCache(nworkers=0),
+                      checksum_wait=True,checksum_timeout=0.05)
+        self.assertFuseError(errno.EAGAIN,box.getxattr,
+                             '/data/myfile','user.fusebox.md5')
+    def test_getxattr_wait_policy(self):
+        box = FuseBox(self.boxfs,checksums=ChecksumCache(),
+                      checksum_wait=True)
+        self.assertEqual(box.getxattr('/data/myfile','user.fusebox.md5'),
+                         '6f5902ac237024bdd0c176cb93063dc4')
+        self.assertEqual(box.getxattr('/data/sub/public','user.fusebox.sha1'),
+                         '22596363b3de40b06f981fb85d82312e8c0ed511')